@@ -1,141 +1,286 @@
 import argparse
-import os
+import atexit
+import queue
 import subprocess
-import json
+import sys
+import orjson
 import logging
-from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor
+import mmap
+from logging.handlers import QueueHandler, QueueListener
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from kubernetes import client, config
+from urllib3.util.retry import Retry
 
 # Parse command-line arguments
 parser = argparse.ArgumentParser(description='Scale and restart deployments in a Kubernetes namespace.')
 parser.add_argument('--kubeconfig', required=True, help='Path to the kubeconfig file')
 parser.add_argument('--namespace', required=True, help='Namespace to operate on')
-parser.add_argument('--scale-down', action='store_true', help='Scale down deployments to 0 replicas')
+parser.add_argument('--scale-down', action='store_true', help='Scale down deployments to 0 replicas (together with --scale-up, performs a rollout restart unless --no-rollout-restart is given)')
 parser.add_argument('--scale-up', action='store_true', help='Scale up deployments to the original replica count')
 parser.add_argument('--dry-run', action='store_true', help='Simulate scaling operations without modifying deployments')
 parser.add_argument('--backup', action='store_true', help='Backup the original replica counts to a file')
 parser.add_argument('--restore', action='store_true', help='Restore the original replica counts from a file')
+parser.add_argument('--rollout-restart', dest='rollout_restart', action='store_true', default=None,
+                    help='Restart deployments by updating their pod template instead of scaling them. This is the default when --scale-down and --scale-up are both given, which then no longer scale to 0')
+parser.add_argument('--no-rollout-restart', dest='rollout_restart', action='store_false',
+                    help='Restart by scaling to 0 and back up when --scale-down and --scale-up are both given (the behaviour before rollout restart became the default)')
+parser.add_argument('--yes', '-y', action='store_true', help='Apply the proposed changes without asking for confirmation')
+parser.add_argument('--parallelism', type=int, default=16, help='Maximum number of concurrent API requests (default: 16)')
 args = parser.parse_args()
 
-# Validate kubeconfig file path
-if not os.path.isfile(args.kubeconfig):
-    raise FileNotFoundError(f"Kubeconfig file not found: {args.kubeconfig}")
+if args.parallelism < 1:
+    parser.error('--parallelism must be at least 1')
+if args.rollout_restart and (args.scale_down != args.scale_up or args.restore):
+    parser.error('--rollout-restart cannot be combined with --restore or with only one of --scale-down and --scale-up')
 
-# Load the kubeconfig file
-config.load_kube_config(args.kubeconfig)
+# Field manager recorded by the API server for changes made by this script
+FIELD_MANAGER = 'namespace-restart'
 
-# Create a Kubernetes API client
-v1 = client.CoreV1Api()
-apps_v1 = client.AppsV1Api()
+# Load the kubeconfig file, sizing the connection pool to match the number of
+# concurrent scale requests so connections are reused instead of discarded
+configuration = client.Configuration()
+configuration.connection_pool_maxsize = args.parallelism
+# Back off only on throttling and transient server errors. Scale patches set an
+# absolute replica count, so retrying PATCH is safe.
+configuration.retries = Retry(
+    total=5,
+    backoff_factor=0.2,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {'PATCH'},
+    raise_on_status=False
+)
+try:
+    config.load_kube_config(args.kubeconfig, client_configuration=configuration)
+except (config.ConfigException, OSError) as e:
+    raise FileNotFoundError(f"Kubeconfig file not found or invalid: {args.kubeconfig}") from e
+
+# Create a single Kubernetes API client shared by the API groups, so they use
+# one connection pool
+api_client = client.ApiClient(configuration)
+# Ask the API server to compress large responses such as deployment lists
+api_client.set_default_header('Accept-Encoding', 'gzip')
+v1 = client.CoreV1Api(api_client)
+apps_v1 = client.AppsV1Api(api_client)
 
-# Configure logging
-log_file = f'namespace-restart-{args.namespace}.log'
-logging.basicConfig(filename=log_file, level=logging.INFO, format='%(asctime)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
-console = logging.StreamHandler()
-console.setLevel(logging.INFO)
-formatter = logging.Formatter('%(message)s')
-console.setFormatter(formatter)
-logging.getLogger('').addHandler(console)
+# Configure logging once. Messages are still formatted on the thread that logs them,
+# but records are queued and written to the log file and console by a listener
+# thread, so the scaling workers do not wait on file or terminal I/O.
+root_logger = logging.getLogger('')
+if not root_logger.handlers:
+    log_file = f'namespace-restart-{args.namespace}.log'
+    file_handler = logging.FileHandler(log_file)
+    file_handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
+    console = logging.StreamHandler()
+    console.setLevel(logging.INFO)
+    formatter = logging.Formatter('%(message)s')
+    console.setFormatter(formatter)
+    log_queue = queue.SimpleQueue()
+    root_logger.setLevel(logging.INFO)
+    root_logger.addHandler(QueueHandler(log_queue))
+    log_listener = QueueListener(log_queue, file_handler, console, respect_handler_level=True)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+
+# Replica counts from the most recent list, keyed by deployment name; None until listed
+_deploy_cache = None
 
 # Function to get deployments in the specified namespace
 def get_deployments():
+    global _deploy_cache
     try:
-        deployments = apps_v1.list_namespaced_deployment(namespace=args.namespace)
-        return deployments.items
+        # Only the name and replica count are needed, so decode the raw list
+        # instead of building a full V1Deployment model for every item
+        response = apps_v1.list_namespaced_deployment(namespace=args.namespace, _preload_content=False)
     except client.rest.ApiException as e:
         logging.error(f"Failed to retrieve deployments in namespace '{args.namespace}': {str(e)}")
         raise
+    deployments = orjson.loads(response.data)['items']
+    _deploy_cache = {deployment['metadata']['name']: deployment['spec'].get('replicas')
+                     for deployment in deployments}
+    return _deploy_cache
+
+# Function to get deployments, listing the namespace only if it has not been listed yet
+def get_cached_deployments():
+    if _deploy_cache is None:
+        get_deployments()
+    return _deploy_cache
+
+# Function to discard a raw API response and return its connection to the pool.
+# The PATCH responses are not used, so they are not deserialized into models.
+def release_response(response):
+    response.drain_conn()
+    response.release_conn()
+
+# Function to build the scale patch body. JSON Patch 'add' also replaces, and
+# works when a scale of 0 omits spec.replicas.
+def scale_patch(replicas):
+    return [
+        {'op': 'add', 'path': '/spec/replicas', 'value': replicas}
+    ]
+
+# Every scale down sends the same body, so build it once
+_BODY_ZERO = scale_patch(0)
 
 # Function to scale a deployment
-def scale_deployment(deployment, replicas):
+def scale_deployment(deployment_name, replicas, retry_on_conflict=True):
+    dry_run = args.dry_run
     try:
-        if not args.dry_run:
-            body = {
-                'spec': {
-                    'replicas': replicas
-                }
-            }
-            apps_v1.patch_namespaced_deployment_scale(
-                name=deployment.metadata.name,
+        if not dry_run:
+            body = _BODY_ZERO if replicas == 0 else scale_patch(replicas)
+            response = apps_v1.patch_namespaced_deployment_scale(
+                name=deployment_name,
                 namespace=args.namespace,
-                body=body
+                body=body,
+                field_manager=FIELD_MANAGER,
+                _content_type='application/json-patch+json',
+                _preload_content=False
             )
-        logging.info(f"{'Simulated ' if args.dry_run else ''}Scaled deployment '{deployment.metadata.name}' to {replicas} replicas")
+            release_response(response)
+        # Let logging format the message only if the record is emitted
+        logging.info("%sScaled deployment '%s' to %s replicas",
+                     'Simulated ' if dry_run else '', deployment_name, replicas)
     except client.rest.ApiException as e:
-        logging.error(f"Failed to scale deployment '{deployment.metadata.name}': {str(e)}")
+        if e.status == 409 and retry_on_conflict:
+            # The patch sets an absolute replica count and does not depend on the
+            # listed state, so simply send it once more
+            logging.info("Conflict scaling deployment '%s', retrying", deployment_name)
+            return scale_deployment(deployment_name, replicas, retry_on_conflict=False)
+        # Failures are reported once, by run_concurrently
         raise
 
+# Function to skip a deployment that is already at its target, so no no-op PATCH is proposed
+def is_noop_change(deployment_name, current_replicas, replicas, direction):
+    if current_replicas != replicas:
+        return False
+    logging.info("Skipping scale %s of deployment '%s', already at %s replicas", direction, deployment_name, replicas)
+    return True
+
 # Function to get the proposed changes for scaling down
 def get_scale_down_changes():
     proposed_changes = {}
-    deployments = get_deployments()
-    for deployment in deployments:
-        proposed_changes[deployment.metadata.name] = deployment.spec.replicas
+    for deployment_name, replicas in get_cached_deployments().items():
+        if not is_noop_change(deployment_name, replicas, 0, 'down'):
+            proposed_changes[deployment_name] = replicas
     return proposed_changes
 
-# Function to get the proposed changes for scaling up
-def get_scale_up_changes(original_replicas):
+# Function to get the proposed changes for scaling up. current_replicas defaults to
+# the listed counts; pass the expected counts when scaling up after a scale down.
+def get_scale_up_changes(original_replicas, current_replicas=None):
+    if current_replicas is None:
+        current_replicas = get_cached_deployments()
     proposed_changes = {}
-    deployments = get_deployments()
-    for deployment in deployments:
-        replicas = original_replicas.get(deployment.metadata.name, 0)
-        proposed_changes[deployment.metadata.name] = replicas
+    for deployment_name in get_cached_deployments():
+        replicas = original_replicas.get(deployment_name, 0)
+        if not is_noop_change(deployment_name, current_replicas[deployment_name], replicas, 'up'):
+            proposed_changes[deployment_name] = replicas
     return proposed_changes
 
+# Function to run a per-deployment API call concurrently, logging failures without aborting the batch
+def run_concurrently(func, deployment_args, action):
+    if not deployment_args:
+        return
+    with ThreadPoolExecutor(max_workers=min(args.parallelism, len(deployment_args))) as executor:
+        submit = executor.submit
+        futures = {submit(func, deployment_name, arg): deployment_name
+                   for deployment_name, arg in deployment_args.items()}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except client.rest.ApiException as e:
+                logging.error("Failed to %s deployment '%s': %s", action, futures[future], e)
+
+# Function to scale deployments concurrently
+def scale_deployments(target_replicas, direction):
+    run_concurrently(scale_deployment, target_replicas, f'scale {direction}')
+
 # Function to scale down deployments
 def scale_down_deployments(proposed_changes):
     logging.info(f'{"Simulating " if args.dry_run else ""}Scaling down deployments in namespace {args.namespace}')
-    original_replicas = {}
-    for deployment_name, replicas in proposed_changes.items():
-        try:
-            deployment = apps_v1.read_namespaced_deployment(name=deployment_name, namespace=args.namespace)
-            original_replicas[deployment_name] = deployment.spec.replicas
-            scale_deployment(deployment, 0)
-        except client.rest.ApiException as e:
-            logging.error(f"Failed to scale down deployment '{deployment_name}': {str(e)}")
+    # Back up every listed deployment, including those already at 0 that
+    # get_scale_down_changes left out
+    original_replicas = dict(get_cached_deployments())
+    scale_deployments(dict.fromkeys(proposed_changes, 0), 'down')
     return original_replicas
 
 # Function to scale up deployments
 def scale_up_deployments(proposed_changes):
     logging.info(f'{"Simulating " if args.dry_run else ""}Scaling up deployments in namespace {args.namespace}')
-    with ThreadPoolExecutor() as executor:
-        futures = []
-        for deployment_name, replicas in proposed_changes.items():
-            try:
-                deployment = apps_v1.read_namespaced_deployment(name=deployment_name, namespace=args.namespace)
-                futures.append(executor.submit(scale_deployment, deployment, replicas))
-            except client.rest.ApiException as e:
-                logging.error(f"Failed to scale up deployment '{deployment_name}': {str(e)}")
-        for future in futures:
-            future.result()
+    scale_deployments(proposed_changes, 'up')
+
+# Function to restart a deployment by stamping its pod template, as kubectl rollout restart does
+def restart_deployment(deployment_name, body):
+    # Failures are reported once, by run_concurrently
+    dry_run = args.dry_run
+    if not dry_run:
+        response = apps_v1.patch_namespaced_deployment(
+            name=deployment_name,
+            namespace=args.namespace,
+            body=body,
+            field_manager=FIELD_MANAGER,
+            _content_type='application/strategic-merge-patch+json',
+            _preload_content=False
+        )
+        release_response(response)
+    logging.info("%sRestarted deployment '%s'", 'Simulated ' if dry_run else '', deployment_name)
+
+# Function to rollout restart deployments
+def rollout_restart_deployments(proposed_changes):
+    logging.info(f'{"Simulating " if args.dry_run else ""}Restarting deployments in namespace {args.namespace}')
+    restarted_at = datetime.now(timezone.utc).isoformat(timespec='seconds')
+    body = {
+        'spec': {
+            'template': {
+                'metadata': {
+                    'annotations': {
+                        'kubectl.kubernetes.io/restartedAt': restarted_at
+                    }
+                }
+            }
+        }
+    }
+    run_concurrently(restart_deployment, dict.fromkeys(proposed_changes, body), 'restart')
 
 # Function to confirm the proposed changes
-def confirm_changes(proposed_changes, scale_down, scale_up):
-    print("Proposed changes:")
+def confirm_changes(proposed_changes, scale_down, scale_up, rollout_restart=False):
+    lines = ["Proposed changes:"]
+    if rollout_restart:
+        lines.append("Rollout restart:")
+        lines.extend(f"- Deployment: {deployment_name}, Replicas: {replicas}"
+                     for deployment_name, replicas in proposed_changes.items())
     if scale_down:
-        print("Scale down:")
-        for deployment_name, replicas in proposed_changes.items():
-            print(f"- Deployment: {deployment_name}, Replicas: {replicas} -> 0")
+        lines.append("Scale down:")
+        lines.extend(f"- Deployment: {deployment_name}, Replicas: {replicas} -> 0"
+                     for deployment_name, replicas in proposed_changes.items())
     if scale_up:
-        print("Scale up:")
-        for deployment_name, replicas in proposed_changes.items():
-            print(f"- Deployment: {deployment_name}, Replicas: 0 -> {replicas}")
+        lines.append("Scale up:")
+        lines.extend(f"- Deployment: {deployment_name}, Replicas: 0 -> {replicas}"
+                     for deployment_name, replicas in proposed_changes.items())
+    lines.append("")
+    sys.stdout.write("\n".join(lines))
+    sys.stdout.flush()
+    if args.yes:
+        return True
     return input("Do you want to proceed with the above changes? (y/n): ").lower() == 'y'
 
 # Function to backup original replica counts
 def backup_original_replicas(original_replicas):
     backup_file = f'original_replicas_{args.namespace}.json'
-    with open(backup_file, 'w') as f:
-        json.dump(original_replicas, f)
+    # Serialize first so the file is written with a single call and an
+    # existing backup is not truncated if serialization fails
+    data = orjson.dumps(original_replicas)
+    with open(backup_file, 'wb') as f:
+        f.write(data)
     logging.info(f"Backed up original replica counts to '{backup_file}'")
 
 # Function to restore original replica counts
 def restore_original_replicas():
     backup_file = f'original_replicas_{args.namespace}.json'
     try:
-        with open(backup_file, 'r') as f:
-            original_replicas = json.load(f)
+        # Parse straight from a memory map instead of copying the file into a buffer
+        with open(backup_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            with memoryview(mm) as view:
+                original_replicas = orjson.loads(view)
         logging.info(f"Restored original replica counts from '{backup_file}'")
         return original_replicas
     except FileNotFoundError:
@@ -144,10 +289,23 @@ def restore_original_replicas():
 
 # Main logic
 try:
-    if args.scale_down and args.scale_up:
+    # Restarting via the pod template is the default when both scale flags are given
+    if args.rollout_restart is None:
+        args.rollout_restart = args.scale_down and args.scale_up
+    if args.rollout_restart:
+        logging.info('Performing rollout restart')
+        proposed_changes = dict(get_cached_deployments())
+        if confirm_changes(proposed_changes, scale_down=False, scale_up=False, rollout_restart=True):
+            if args.backup:
+                backup_original_replicas(proposed_changes)
+            rollout_restart_deployments(proposed_changes)
+        else:
+            logging.info('Changes canceled by the user')
+    elif args.scale_down and args.scale_up:
         logging.info('Performing scale down and scale up')
         proposed_changes_down = get_scale_down_changes()
-        proposed_changes_up = get_scale_up_changes(proposed_changes_down)
+        # Every deployment is at 0 once the scale down has run
+        proposed_changes_up = get_scale_up_changes(proposed_changes_down, dict.fromkeys(get_cached_deployments(), 0))
         if confirm_changes(proposed_changes_down, scale_down=True, scale_up=True):
             original_replicas = scale_down_deployments(proposed_changes_down)
             if args.backup:
@@ -166,15 +324,8 @@ try:
             logging.info('Changes canceled by the user')
     elif args.scale_up:
         logging.info('Performing scale up')
-        if args.restore:
-            original_replicas = restore_original_replicas()
-        else:
-            try:
-                with open(f'original_replicas_{args.namespace}.json', 'r') as f:
-                    original_replicas = json.load(f)
-            except FileNotFoundError:
-                logging.error(f"Original replicas file not found for namespace '{args.namespace}'")
-                original_replicas = {}
+        # The backup file is read with or without --restore
+        original_replicas = restore_original_replicas()
         proposed_changes = get_scale_up_changes(original_replicas)
         if confirm_changes(proposed_changes, scale_down=False, scale_up=True):
             scale_up_deployments(proposed_changes)
@@ -183,7 +334,8 @@ try:
     elif args.dry_run:
         logging.info('Performing a dry run')
         proposed_changes_down = get_scale_down_changes()
-        proposed_changes_up = get_scale_up_changes(proposed_changes_down)
+        # Every deployment is at 0 once the scale down has run
+        proposed_changes_up = get_scale_up_changes(proposed_changes_down, dict.fromkeys(get_cached_deployments(), 0))
         if confirm_changes(proposed_changes_down, scale_down=True, scale_up=True):
             scale_down_deployments(proposed_changes_down)
             scale_up_deployments(proposed_changes_up)